@@ -1,71 +1,130 @@
 import terrapi as tp
 from xpipe.config import load_config
 import click
-import time
+import logging
+import os
+import signal
+import threading
 import board
 import adafruit_dht
 import RPi.GPIO as GPIO
 
+log = logging.getLogger(__name__)
+
 follow_planning = True 
 current_mode = None
 devices_pins = {} 
 
+_config_cache = {} # Config path -> (files signature, loaded config)
 
-@click.command()
-@click.option('--conf', help='Path to config file', required=True)
-def run(conf):
-    run_robust(conf)
-
-
-def run_robust(conf):
 
-    client = None 
+def config_signature(conf):
+    # Included files (planning, modes) live next to the main file, so watch the whole directory
+    conf_dir = os.path.dirname(os.path.abspath(conf))
+    return tuple(sorted(
+        (entry.name, entry.stat().st_mtime_ns)
+        for entry in os.scandir(conf_dir) if entry.name.endswith((".yaml", ".yml"))
+    ))
 
-    while True:
-        try:
-            global follow_planning
-            global current_mode
-            global devices_pins
 
-            follow_planning = True 
-            current_mode = None
-            devices_pins = {} 
+def load_config_cached(conf):
+    # Only parse the yaml again if one of the config files changed
+    signature = config_signature(conf)
+    cached = _config_cache.get(conf)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
 
-            GPIO.setmode(GPIO.BCM)
+    config = load_config(conf)
+    _config_cache[conf] = (signature, config)
+    return config
 
-            # Load config file
-            config = load_config(conf)
 
-            # Connect to mosquitto broker
-            client = tp.client.MosquittoClient(config.mqtt.host(), config.mqtt.port())
-            client.connect(config.mqtt.user(), config.mqtt.password())
+@click.command()
+@click.option('--conf', help='Path to config file', required=True)
+@click.option('--log-level', help='Logging level (e.g. DEBUG, INFO, WARNING)', default='INFO')
+def run(conf, log_level):
+    logging.basicConfig(level=log_level.upper(), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    run_robust(conf)
 
-            # Create the terrarium
-            terrarium = tp.terrarium.Terrarium(config)
 
-            # Create TerraHandler
-            terra_handler = tp.terra_handler.TerraHandler(terrarium, client, config)
+def run_robust(conf):
 
-            # run 
-            terra_handler.run()
+    client = None 
+    client_config = None # Config the client was created from
+    terrarium = None
+    terrarium_config = None # Config the terrarium was created from
+    terra_handler = None
+    stopping = threading.Event()
+
+    def on_sigterm(signum, frame):
+        # Stop gracefully (e.g. systemctl stop), the handler returns from run() at its next wake-up
+        stopping.set()
+        if terra_handler is not None:
+            terra_handler.stop()
+
+    signal.signal(signal.SIGTERM, on_sigterm)
+
+    try:
+        while not stopping.is_set():
+            try:
+                global follow_planning
+                global current_mode
+                global devices_pins
+
+                follow_planning = True 
+                current_mode = None
+                devices_pins = {} 
+
+                # Load config file (cached, only parsed again when a file changed)
+                config = load_config_cached(conf)
+
+                # Connect to mosquitto broker. Once connected, the client is kept across retries
+                # and paho reconnects it by itself
+                if client is None or client_config is not config:
+                    if client is not None:
+                        client.disconnect()
+                    # Optional, defaults to terrapi-<hostname> which may not be unique on a shared broker
+                    client_id = config.mqtt.client_id() if "client_id" in config.mqtt else None
+                    client = tp.client.MosquittoClient(config.mqtt.host(), config.mqtt.port(), client_id)
+                    client.connect(config.mqtt.user(), config.mqtt.password())
+                    client_config = config
+
+                # Create the terrarium, only rebuilt when the config changed
+                if terrarium is None or terrarium_config is not config:
+                    # Release the pins of the previous terrarium (nothing is set up on the first pass)
+                    if terrarium is not None:
+                        terrarium.close()
+                        GPIO.cleanup()
+                    GPIO.setmode(GPIO.BCM)
+                    terrarium = tp.terrarium.Terrarium(config)
+                    terrarium_config = config
+
+                # Create TerraHandler
+                terra_handler = tp.terra_handler.TerraHandler(terrarium, client, config)
+                if stopping.is_set():
+                    break
+
+                # run, only returns once the handler was stopped
+                terra_handler.run()
         
-        except KeyboardInterrupt:
-            print("Exiting")
-            GPIO.cleanup()
+            except KeyboardInterrupt:
+                break
+
+            except Exception as e:
+                # Log the whole stack trace
+                log.exception("Error, retrying in 10s")
+                stopping.wait(10)
+
+    except KeyboardInterrupt:
+        # Ctrl-C during the retry wait, outside of the inner handler
+        pass
+
+    finally:
+        log.info("Exiting")
+        if terrarium is not None:
+            terrarium.close()
+        GPIO.cleanup()
+        if client is not None:
             client.disconnect()
-            exit(0)
-
-        except Exception as e:
-            # Print whole stack trace
-            import traceback
-            traceback.print_exc()
-            
-            print("Retrying in 10s")
-
-            GPIO.cleanup()
-
-            if client is not None:
-                client.disconnect()
-            time.sleep(10)
 
 run()
\ No newline at end of file
@@ -1,4 +1,10 @@
 import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+import logging
+import socket
+
+log = logging.getLogger(__name__)
 
 class Client():
 
@@ -10,13 +16,49 @@ class Client():
 
 class MosquittoClient(Client):
 
-    def __init__(self, host, port):
+    def __init__(self, host, port, client_id=None):
         super().__init__(host, port)
-        self.client = mqtt.Client()
+        # The broker can only resume our session if the client id is the same on every connection
+        if client_id is None:
+            client_id = f"terrapi-{socket.gethostname()}"
+        self.client = mqtt.Client(client_id=client_id, protocol=mqtt.MQTTv5)
+        # Telemetry is QoS 0 and never queued. Only a few QoS 1 state messages may wait for the broker,
+        # so a long outage cannot make paho buffer without bounds
+        self.client.max_inflight_messages_set(1)
+        self.client.max_queued_messages_set(10)
+        self.client.reconnect_delay_set(min_delay=1, max_delay=60)
+        self._subscriptions = {} # Topic -> qos, restored on reconnect
+
+        # Callbacks are set once, the paho client is reused across reconnects
+        self.client.on_connect = self._on_connect
+
+    def _on_connect(self, client, userdata, flags, rc, properties=None):
+        if rc != 0:
+            # Refused (e.g. bad credentials), paho keeps retrying
+            log.warning("Connection refused by broker (rc=%s)", rc)
+            return
+        log.info("Connected to broker")
+        self._tune_socket()
+        # Restore the subscriptions if the broker did not keep our session
+        if self._subscriptions and not flags.get("session present"):
+            client.subscribe(list(self._subscriptions.items()))
 
     def connect(self, username, password):
         self.client.username_pw_set(username, password)
-        self.client.connect(self.host, self.port)
+        # Keep the session on the broker across reconnects
+        properties = Properties(PacketTypes.CONNECT)
+        properties.SessionExpiryInterval = 3600
+        self.client.connect(self.host, self.port, clean_start=False, properties=properties)
+        # Network traffic and reconnections are handled by paho's own thread
+        self.client.loop_start()
+
+    def _tune_socket(self):
+        # Disable Nagle so small sensor messages are not delayed, and let the OS detect dead links
+        sock = self.client.socket()
+        if sock is None:
+            return
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
 
     def send_message(self, topic, message):
         self.client.publish(topic, message)
@@ -26,12 +68,19 @@ class MosquittoClient(Client):
         
     def disconnect(self):
         self.client.disconnect()
+        self.client.loop_stop()
 
     def subscribe(self, topic):
+        # Accepts a topic or a list of (topic, qos) tuples like paho
+        topics = [(topic, 0)] if isinstance(topic, str) else topic
+        self._subscriptions.update(topics)
         self.client.subscribe(topic)
 
-    def publish(self, topic, message):
-        self.client.publish(topic, message)
-    
-    def loop(self, timeout):
-        self.client.loop(timeout=timeout)
\ No newline at end of file
+    def publish(self, topic, message, qos=0, retain=False):
+        self.client.publish(topic, message, qos=qos, retain=retain)
+
+    def publish_many(self, messages, qos=0, retain=False):
+        # Publish (topic, message) pairs back to back
+        publish = self.client.publish
+        for topic, message in messages:
+            publish(topic, message, qos=qos, retain=retain)
\ No newline at end of file
@@ -12,6 +12,15 @@ class Control():
     def switch_off(self):
         pass
 
+    def switch(self, state):
+        # Nothing to do if the control is already in the requested state
+        if state == self._state:
+            return
+        if state:
+            self.switch_on()
+        else:
+            self.switch_off()
+
 
 class Relay(Control):
 
@@ -27,10 +36,4 @@ class Relay(Control):
 
     def switch_off(self):
         GPIO.output(self._pin, GPIO.HIGH)
-        self._state = False
-
-    def switch(self, state):
-        if state:
-            self.switch_on()
-        else:
-            self.switch_off()
\ No newline at end of file
+        self._state = False
\ No newline at end of file
@@ -1,5 +1,12 @@
 import board
 import adafruit_dht
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+# GPIO number -> board pin (board.D4, board.D17, ...)
+_BOARD_PINS = {int(name[1:]): getattr(board, name) for name in dir(board) if name.startswith("D") and name[1:].isdigit()}
 
 class Sensor():
 
@@ -9,24 +16,59 @@ class Sensor():
     def get_data(self):
         pass
 
+    def close(self):
+        # Release the hardware used by the sensor
+        pass
+
 
 class DHT22(Sensor):
 
+    ERROR_LOG_EVERY = 10 # Read errors are frequent on DHT22, only log one out of this many
+    RESET_AFTER = 20 # Recreate the device after this many consecutive read errors
+    WARMUP = 2 # Seconds to wait after creating the device before the first read
+
     def __init__(self, pin):
         super().__init__(pin)
-        dht_pin = self._pin
-        dht_pin = getattr(board, f"D{dht_pin}")
-        self.dht_device = adafruit_dht.DHT22(dht_pin)
+        # xpipe passes object parameters as strings
+        self._board_pin = _BOARD_PINS.get(int(self._pin))
+        if self._board_pin is None:
+            raise ValueError(f"Pin {self._pin} is not available on this board")
+        # The device is created once and reused for every read
+        self.dht_device = adafruit_dht.DHT22(self._board_pin)
+        self._ready_at = time.monotonic() + self.WARMUP
+        self._error_count = 0
+        self._consecutive_errors = 0
+
+    def close(self):
+        self.dht_device.exit()
+
+    def _reset_device(self):
+        log.warning("DHT22 on pin %s failed %d times in a row, resetting it", self._pin, self._consecutive_errors)
+        self.dht_device.exit()
+        self.dht_device = adafruit_dht.DHT22(self._board_pin)
+        self._ready_at = time.monotonic() + self.WARMUP
+        self._consecutive_errors = 0
 
     def get_data(self):
 
+        # Only the first reads can wait, and they run off the control loop
+        remaining = self._ready_at - time.monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
+
         try:
             temperature = self.dht_device.temperature
             humidity = self.dht_device.humidity
+            self._consecutive_errors = 0
             return {
                 "temperature": temperature,
                 "humidity": humidity
             }
         except RuntimeError as error:
-            print(error.args[0])
+            self._error_count += 1
+            self._consecutive_errors += 1
+            if (self._error_count - 1) % self.ERROR_LOG_EVERY == 0:
+                log.debug("DHT22 on pin %s: %s (%d read errors so far)", self._pin, error.args[0], self._error_count)
+            if self._consecutive_errors >= self.RESET_AFTER:
+                self._reset_device()
             return None
\ No newline at end of file
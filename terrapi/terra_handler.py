@@ -4,9 +4,39 @@ import RPi.GPIO as GPIO
 import terrapi.sensor as sensor
 from terrapi.terrarium import Terrarium
 from xpipe.config import to_dict
+from concurrent.futures import ThreadPoolExecutor
+import threading
 import time
-from datetime import datetime
 import json
+import logging
+import re
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+log = logging.getLogger(__name__)
+
+MINUTES_PER_DAY = 24 * 60
+_TIME_RE = re.compile(r"^([01]?\d|2[0-3]):([0-5]\d)$")
+
+
+def _to_minutes(time_str):
+    # "HH:MM" to minutes of the day
+    match = _TIME_RE.match(str(time_str))
+    if match is None:
+        raise ValueError(f"Invalid time {time_str!r} in planning, expected HH:MM")
+    return int(match.group(1)) * 60 + int(match.group(2))
+
+
+def to_json_bytes(data):
+    # orjson is a C extension and much faster on the Pi, use the standard library when it is missing
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data).encode("utf-8")
+
 
 class TerraHandler():
 
@@ -19,124 +49,258 @@ class TerraHandler():
         self._current_mode = None
         self._default_mode = conf.planning.default_mode() # Default mode
         self._planning_periods = conf.planning.periods # Planning periods
+        self._mode_names = list(conf.modes) # Available modes, fixed for the lifetime of the handler
+        self._mode_by_minute = self._build_mode_by_minute() # Planned mode for every minute of the day
+        self._conf_json = None # Serialized get_conf reply, reset when the mode or planning state changes
+        # Sensor reads can block for seconds (DHT22), they run in a pool so they never delay the control loop
+        self._sensor_pool = ThreadPoolExecutor(max_workers=max(1, len(terra.sensors)), thread_name_prefix="sensor")
+        self._sensor_reads = {} # Sensor name -> future of its last read
+        self._control_states = self._build_control_states() # (mode, control) -> target state
+        self._sensor_topics = {} # (sensor, data name or None) -> mqtt topic
+        self._last_published = {} # Topic -> (last value published, monotonic time), retained by the broker
+        self._stop = threading.Event() # Set to make run() return
+        self._lock = threading.RLock() # MQTT callbacks run on paho's thread, protects the mode and planning state
 
-        self._loop_interval = 1 # Loop interval in seconds
         self._log_interval = conf.log_interval() # Log interval in seconds
-        self._last_log = 0 # Last time the data was logged
+        self._log_count = 0 # Log intervals elapsed, the n-th log is due log_interval * n after the start
+        # Numeric values closer than this to the last published one are not sent again
+        self._value_epsilon = conf.publish_epsilon() if "publish_epsilon" in conf else 0.1
+        # Every value is still published at least this often (seconds)
+        self._heartbeat_interval = conf.heartbeat_interval() if "heartbeat_interval" in conf else 60
+        # Publish each sensor field on its own topic, or each sensor as a single json message
+        self._flat_publish = conf.flat_publish() if "flat_publish" in conf else True
 
+        # Handlers of the subscribed topics
+        self._topic_handlers = {
+            "planning/active": self._on_planning_active,
+            "mode/set": self._on_mode_set,
+            "get_conf": self._on_get_conf,
+        }
 
-    def _handle_message(self, client, userdata, message):
-        # Topics possible: 
-        #  - planning/active 
-        #  - mode/set (works only if planning is not active)
 
-        # Get the topic and the message
+    def _handle_message(self, client, userdata, message):
+        # Get the topic and the raw payload (only decoded when a string is needed)
         topic = message.topic
-        message = message.payload.decode("utf-8")
+        payload = message.payload
+
+        log.debug("Received message on topic %s: %r", topic, payload)
+        handler = self._topic_handlers.get(topic)
+        if handler is None:
+            log.warning("Unknown topic %s", topic)
+            return
+        # This runs on paho's network thread, an exception here would silently kill it
+        try:
+            handler(payload)
+        except Exception:
+            log.exception("Error while handling message on topic %s", topic)
+
 
-        print(f"Received message on topic {topic}: {message}")
-        if topic == "planning/active":
-            self._follow_planning = message == "1"
+    def _on_planning_active(self, payload):
+        follow_planning = payload == b"1"
+        with self._lock:
+            if follow_planning != self._follow_planning:
+                self._follow_planning = follow_planning
+                self._conf_json = None
+                self._update_controls()
 
-        elif topic == "mode/set":
+
+    def _on_mode_set(self, payload):
+        # Works only if planning is not active
+        with self._lock:
             if not self._follow_planning:
-                self.set_mode(message)
-        elif topic == "get_conf":
-            print("Sending conf")
-            conf = {
-                "planning": {
-                    "active": self._follow_planning,
-                },
-                "modes": list(self._conf.modes),
-                "current_mode": self._current_mode
-            }
-            self._mqtt_client.publish("conf", json.dumps(conf))
+                mode = payload.decode("utf-8", errors="replace")
+                # An unknown mode would switch every control off
+                if mode not in self._mode_names:
+                    log.warning("Ignoring unknown mode %r", mode)
+                    return
+                self.set_mode(mode)
+                self._update_controls()
 
-        else:
-            print(f"Unknown topic {topic}")
-        
+
+    def _on_get_conf(self, payload):
+        log.debug("Sending conf")
+        with self._lock:
+            if self._conf_json is None:
+                conf = {
+                    "planning": {
+                        "active": self._follow_planning,
+                    },
+                    "modes": self._mode_names,
+                    "current_mode": self._current_mode
+                }
+                self._conf_json = to_json_bytes(conf)
+            conf_json = self._conf_json
+        self._mqtt_client.publish("conf", conf_json, qos=1)
 
 
     def run(self):
 
-        # Subscribe to topics
-        self._mqtt_client.subscribe("planning/active")
-        self._mqtt_client.subscribe("mode/set")
-        self._mqtt_client.subscribe("get_conf")
-        
+        # Set the callback first, retained messages can arrive as soon as we subscribe
         self._mqtt_client.on_message(self._handle_message)
 
+        # Subscribe to all topics in a single SUBSCRIBE packet
+        self._mqtt_client.subscribe([(topic, 0) for topic in self._topic_handlers])
+
         # Start the loop
-        while True:
+        try:
+            start = time.monotonic()
+            next_log = start
+            last_minutes = None
+            while not self._stop.is_set():
 
-            # Get the data from the sensors
-            data = {}
-            for sensor_name, sensor in self._terrarium.sensors.items():
-                data[sensor_name] = sensor.get_data()
-            
-            # Send the data to mqtt
-            if time.time() - self._last_log >= self._log_interval:
-                self._last_log = time.time()
-                for sensor_name, sensor_data in data.items():
+                # Sample the clocks once per iteration
+                now = time.monotonic()
+                current_time = time.localtime()
+                current_minutes = current_time.tm_hour * 60 + current_time.tm_min
+
+                # Get the mode and set the controls. The planning has a one minute resolution and
+                # planning/mode messages update the controls themselves, so once per minute is enough
+                if current_minutes != last_minutes:
+                    last_minutes = current_minutes
+                    self._update_controls(current_minutes)
+
+                # Read the sensors and send the data to mqtt, the data is only used for logging
+                if now >= next_log:
+                    # Skip the intervals missed by a late wake-up, keeping the cadence
+                    self._log_count = max(self._log_count + 1, int((now - start) / self._log_interval) + 1)
+                    next_log = start + self._log_count * self._log_interval
+                    for sensor_name, sensor in self._terrarium.sensors_items:
+                        # Skip a sensor whose previous read is still running
+                        pending_read = self._sensor_reads.get(sensor_name)
+                        if pending_read is None or pending_read.done():
+                            self._sensor_reads[sensor_name] = self._sensor_pool.submit(self._read_sensor, sensor_name, sensor)
+
+                    # Send the current mode
+                    if self._should_publish("mode", self._current_mode, now):
+                        self._mqtt_client.publish("mode", self._current_mode, qos=1, retain=True)
+                        log.debug("mode: %s", self._current_mode)
+
+                # Sleep until the next log or the next minute, whichever comes first.
+                # Messages are handled meanwhile by paho's thread
+                next_minute = 60 - time.time() % 60
+                self._stop.wait(max(0, min(next_log - time.monotonic(), next_minute)))
+
+        finally:
+            # Let running reads finish, the terrarium may be reused by another handler
+            self._sensor_pool.shutdown(wait=True)
+
+
+    def _read_sensor(self, sensor_name, sensor):
+        # Runs in the sensor pool: read one sensor and publish its data
+        try:
+            sensor_data = sensor.get_data()
+        except Exception:
+            log.exception("Error while reading data from sensor %s", sensor_name)
+            return
 
-                    if sensor_data is None:
-                        print(f"Error while reading data from sensor {sensor_name}")
-                        continue
+        if sensor_data is None:
+            # Failed reads are expected and already logged (rate limited) by the sensor
+            log.debug("No data from sensor %s", sensor_name)
+            return
 
-                    for data_name, data_value in sensor_data.items():
-                        self._mqtt_client.publish(f"sensor/{sensor_name}/{data_name}", str(data_value))
-                        print(f"sensor/{sensor_name}/{data_name}: {str(data_value)}")
+        now = time.monotonic()
+        if not self._flat_publish:
+            # Compare each field so the epsilon applies, and only serialize when something is sent
+            changed = [self._should_publish(self._sensor_topic(sensor_name, data_name), data_value, now)
+                       for data_name, data_value in sensor_data.items()]
+            if any(changed):
+                # Every field goes out in the message, restart all their heartbeats
+                for data_name, data_value in sensor_data.items():
+                    self._last_published[self._sensor_topic(sensor_name, data_name)] = (data_value, now)
+                topic = self._sensor_topic(sensor_name)
+                self._mqtt_client.publish(topic, to_json_bytes(sensor_data), qos=0, retain=True)
+                log.debug("%s: %s", topic, sensor_data)
+            return
 
-                # Send the current mode
-                self._mqtt_client.publish("mode", self._current_mode)
-                print(f"mode: {self._current_mode}")
+        messages = []
+        for data_name, data_value in sensor_data.items():
+            topic = self._sensor_topic(sensor_name, data_name)
+            if self._should_publish(topic, data_value, now):
+                messages.append((topic, str(data_value)))
+                log.debug("%s: %s", topic, data_value)
+        self._mqtt_client.publish_many(messages, qos=0, retain=True)
 
-            # Get the mode
-            tmp_mode = self.get_mode()
-            self.set_mode(tmp_mode)
 
-            mode_params = self._conf.modes[self._current_mode]
-            target_controls_states = {control_name: mode_params[control_name]() for control_name in mode_params.keys()}
+    def _should_publish(self, topic, value, now):
+        # Values are retained by the broker, so they only need to be published when they change.
+        # A heartbeat still republishes them from time to time so subscribers know the sensors are alive
+        last = self._last_published.get(topic)
+        if last is not None:
+            last_value, last_time = last
+            if now - last_time < self._heartbeat_interval:
+                if value == last_value:
+                    return False
+                # Rounded so that a change of exactly epsilon (e.g. one 0.1 step of the DHT22) is always sent,
+                # whatever the float error of the subtraction
+                if isinstance(value, (int, float)) and isinstance(last_value, (int, float)) \
+                        and round(abs(value - last_value), 6) < self._value_epsilon:
+                    return False
+        self._last_published[topic] = (value, now)
+        return True
 
-            for control_name, control in self._terrarium.controls.items():
-                # Set the control state
-                control.switch(target_controls_states.get(control_name, target_controls_states[control_name]))
 
-            # Receive messages
-            self._mqtt_client.loop(timeout=1)
+    def _update_controls(self, current_minutes=None):
+        # Update the mode and switch the controls accordingly
+        with self._lock:
+            self.set_mode(self.get_mode(current_minutes))
+            for control_name, control in self._terrarium.controls_items:
+                # Set the control state (off if the mode does not mention the control)
+                control.switch(self._control_states.get((self._current_mode, control_name), False))
+
+
+    def stop(self):
+        # Make run() return
+        self._stop.set()
+
+
+    def _sensor_topic(self, sensor_name, data_name=None):
+        # Topics are formatted once per sensor field (or per sensor for json messages)
+        key = (sensor_name, data_name)
+        topic = self._sensor_topics.get(key)
+        if topic is None:
+            topic = f"sensor/{sensor_name}" if data_name is None else f"sensor/{sensor_name}/{data_name}"
+            self._sensor_topics[key] = topic
+        return topic
 
 
     def set_mode(self, mode):
         if mode != self._current_mode:
-            print(f"Changing mode from {self._current_mode} to {mode}")
+            log.info("Changing mode from %s to %s", self._current_mode, mode)
             self._current_mode = mode
+            self._conf_json = None
 
 
-    def get_mode(self):
+    def get_mode(self, current_minutes=None):
         # Set mode according to the planning if needed
         if self._follow_planning:
-            current_time = datetime.now()
-            for period in self._planning_periods.values():
-                # Str to hour and minute
-                start_hour, start_minute = period.start().split(":")
-                end_hour, end_minute = period.end().split(":")
-                start_hour, start_minute = int(start_hour), int(start_minute)
-                end_hour, end_minute = int(end_hour), int(end_minute)
-
-                # Check if the current time is in the period
-                if start_hour <= current_time.hour <= end_hour:
-                    if start_hour == current_time.hour:
-                        if current_time.minute < start_minute:
-                            continue
-                    if end_hour == current_time.hour:
-                        if current_time.minute >= end_minute:
-                            continue
-                    return period.mode()
-
-                
-            # If no period is active, return the default mode
-            return self._default_mode
+            if current_minutes is None:
+                current_time = time.localtime()
+                current_minutes = current_time.tm_hour * 60 + current_time.tm_min
+            return self._mode_by_minute[current_minutes]
             
         else:
             # Remain unchanged
-            return self._current_mode
\ No newline at end of file
+            return self._current_mode
+
+
+    def _build_control_states(self):
+        # Read the target state of every control in every mode once from the config
+        control_states = {}
+        for mode_name, mode_params in self._conf.modes.items():
+            for control_name in mode_params.keys():
+                control_states[(mode_name, control_name)] = mode_params[control_name]()
+        return control_states
+
+
+    def _build_mode_by_minute(self):
+        # Minutes not covered by any period use the default mode
+        mode_by_minute = [self._default_mode] * MINUTES_PER_DAY
+        # Periods are half-open [start, end) and wrap around midnight when end < start.
+        # They are written in reverse so that the first matching period wins.
+        for period in reversed(list(self._planning_periods.values())):
+            start = _to_minutes(period.start())
+            end = _to_minutes(period.end())
+            mode = period.mode()
+            for minute in range(start, start + (end - start) % MINUTES_PER_DAY):
+                mode_by_minute[minute % MINUTES_PER_DAY] = mode
+        return mode_by_minute
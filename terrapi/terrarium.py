@@ -1,12 +1,25 @@
 from xpipe.config import to_dict
-import time
+import logging
+
+log = logging.getLogger(__name__)
 
 class Terrarium():
 
     def __init__(self, conf):
         self._conf = conf
-        print("Initializing sensors...")
+        log.info("Initializing sensors...")
         self.sensors = { sensor_name: sensor() for sensor_name, sensor in conf.sensors.items() }
-        time.sleep(2)
-        print("Initializing controls...")
-        self.controls = { control_name: control() for control_name, control in conf.controls.items() }
\ No newline at end of file
+        log.info("Initializing controls...")
+        self.controls = { control_name: control() for control_name, control in conf.controls.items() }
+
+        # The sensors and controls never change, iterate over frozen (name, object) tuples
+        self.sensors_items = tuple(self.sensors.items())
+        self.controls_items = tuple(self.controls.items())
+
+    def close(self):
+        # Release the sensors, a new terrarium may use the same pins
+        for sensor_name, sensor in self.sensors_items:
+            try:
+                sensor.close()
+            except Exception:
+                log.exception("Error while closing sensor %s", sensor_name)
@@ -1,5 +1,7 @@
 
-import enum
+# Thermostat modes
+HEAT, COOL = 0, 1
+_MODE_IDS = {"heat": HEAT, "cool": COOL}
 
 
 class Controller():
@@ -20,11 +22,6 @@ class Controller():
         raise NotImplementedError()
 
 
-class ThermostatMode(enum.Enum):
-    HEAT = "heat"
-    COOL = "cool"
-
-
 class Thermostat(Controller):
     def __init__(self, sensors_names, thresh_temp, release_delta, mode):
         """
@@ -37,8 +34,13 @@ class Thermostat(Controller):
         """
         self.thresh_temp = thresh_temp
         self.release_delta = release_delta
-        self.mode = ThermostatMode(mode)
+        if mode not in _MODE_IDS:
+            raise ValueError(f"Invalid thermostat mode {mode!r}")
+        self.mode = mode
+        self._mode_id = _MODE_IDS[mode]
         self._last_state = None
+        # Resolve the mode once, should_switch doesn't compare it anymore
+        self._switch_impl = self._switch_heat if self._mode_id == HEAT else self._switch_cool
         super().__init__(sensors_names)
         
 
@@ -49,24 +51,33 @@ class Thermostat(Controller):
         Args:
             temp (float): Current temperature
         """
-        temp = sensor_values[0]["temperature"]
-        if self.mode == ThermostatMode.HEAT:
-            if temp < self.thresh_temp - self.release_delta:
-                self._last_state = True
-                return True
-            elif temp > self.thresh_temp:
-                self._last_state = False
-                return False
-            else:
-                return self._last_state
-        elif self.mode == ThermostatMode.COOL:
-            if temp > self.thresh_temp + self.release_delta:
-                self._last_state = True
-                return True
-            elif temp < self.thresh_temp:
-                self._last_state = False
-                return False
-            else:
-                return self._last_state
-        else:
-            raise ValueError("Invalid thermostat mode")
+        return self._switch_impl(sensor_values[0]["temperature"])
+
+
+    def _switch_heat(self, temp):
+        self._last_state = self.next_state(self._last_state, temp, self.thresh_temp, self.release_delta, True)
+        return self._last_state
+
+
+    def _switch_cool(self, temp):
+        self._last_state = self.next_state(self._last_state, temp, self.thresh_temp, self.release_delta, False)
+        return self._last_state
+
+
+    @staticmethod
+    def next_state(last_state, temp, thresh_temp, release_delta, heat):
+        """
+        Computes the next state of a thermostat with boolean arithmetic instead of nested branches
+
+        Args:
+            last_state (bool): Previous state of the thermostat (None if unknown)
+            temp (float): Current temperature
+            thresh_temp (float): Temperature threshold to switch the thermostat
+            release_delta (float): Hysteresis around the threshold
+            heat (bool): True for heating, False for cooling
+        """
+        # Signed distance to the threshold, positive on the side where the thermostat should work
+        delta = (thresh_temp - temp) * (1 if heat else -1)
+        switch_on = delta > release_delta
+        switch_off = delta < 0
+        return switch_on or (bool(last_state) and not switch_off)